@@ -68,24 +68,41 @@ def ffprobe_cmd(params):
     return raw_output
 
 
-def ffprobe_file(vid_file_path):
+def ffprobe_file(vid_file_path, select_streams=None, show_entries=None, quick=False):
     """
     Returns a dictionary result from ffprobe command line prove of a file
 
     :param vid_file_path: The absolute (full) path of the video file, string.
+    :param select_streams: Optional stream specifier to limit the probe to (eg. 'a' for audio streams only).
+    :param show_entries: Optional entries string limiting the stream fields fetched (eg. 'stream=codec_name,channels').
+    :param quick: If True, cap the probe to the container headers rather than decoding frames for stream info.
     :return:
     """
     if type(vid_file_path) != str:
         raise Exception('Give ffprobe a full file path of the video')
 
-    params = [
+    params = []
+    if quick:
+        # Cap the amount of data ffprobe will read/decode to infer stream info
+        # well below its defaults (5MB and a 5 second analysis window).
+        # Well-formed containers describe their streams up front.
+        params += [
+            "-probesize", "1M",
+            "-analyzeduration", "1000000",
+        ]
+    params += [
         "-loglevel", "quiet",
         "-print_format", "json",
         "-show_format",
-        "-show_streams",
         "-show_error",
-        vid_file_path
     ]
+    if select_streams:
+        params += ["-select_streams", select_streams]
+    if show_entries:
+        params += ["-show_entries", show_entries]
+    else:
+        params += ["-show_streams"]
+    params += [vid_file_path]
 
     # Check result
     results = ffprobe_cmd(params)
@@ -97,6 +114,28 @@ def ffprobe_file(vid_file_path):
     return info
 
 
+def probe_contains_required_fields(probe_info, allow_empty_streams=False):
+    """
+    Test that a probe result contains the stream fields read by the plugins.
+    A quick (header only) probe may return streams missing these fields for
+    pathological containers, in which case a full probe is required.
+
+    :param probe_info:
+    :param allow_empty_streams: An empty stream list is expected when the probe was limited with a stream specifier.
+    :return:
+    """
+    streams = probe_info.get('streams')
+    if not streams:
+        return bool(allow_empty_streams and probe_info.get('format'))
+    for stream_info in streams:
+        codec_type = stream_info.get('codec_type', '').lower()
+        if codec_type in ['video', 'audio', 'subtitle'] and not stream_info.get('codec_name'):
+            return False
+        if codec_type == 'audio' and not stream_info.get('channels'):
+            return False
+    return True
+
+
 class Probe(object):
     """
     Probe
@@ -174,12 +213,14 @@ class Probe(object):
         data['shared_info']['ffprobe'] = probe.get_probe()
         return probe
 
-    def file(self, file_path):
+    def file(self, file_path, select_streams=None, show_entries=None):
         """
         Sets the 'probe' dict by probing the given file path.
         Files that are not able to be probed will not set the 'probe' dict.
 
         :param file_path:
+        :param select_streams:
+        :param show_entries:
         :return:
         """
         self.probe_info = {}
@@ -193,8 +234,17 @@ class Probe(object):
             return
 
         try:
-            # Get the file probe info
-            self.probe_info = ffprobe_file(file_path)
+            # Get the file probe info.
+            # Start with a quick probe capped to the container headers and only
+            # fall back to a full (frame decoding) probe when the headers did
+            # not provide the required stream fields.
+            try:
+                self.probe_info = ffprobe_file(
+                    file_path, select_streams=select_streams, show_entries=show_entries, quick=True)
+            except FFProbeError:
+                self.probe_info = {}
+            if not probe_contains_required_fields(self.probe_info, allow_empty_streams=bool(select_streams)):
+                self.probe_info = ffprobe_file(file_path, select_streams=select_streams, show_entries=show_entries)
             return True
         except FFProbeError:
             # This will only happen if it was not a file that could be probed.
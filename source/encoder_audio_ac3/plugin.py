@@ -21,16 +21,89 @@
         If not, see <https://www.gnu.org/licenses/>.
 
 """
+import functools
+import hashlib
 import logging
+import mimetypes
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from configparser import NoSectionError, NoOptionError
 
 from unmanic.libs.unplugins.settings import PluginSettings
+from unmanic.libs.directoryinfo import UnmanicDirectoryInfo
 
 from encoder_audio_ac3.lib.ffmpeg import StreamMapper, Probe, Parser
+from encoder_audio_ac3.lib.ffmpeg.mimetype_overrides import MimetypeOverrides
 
 # Configure plugin logger
 logger = logging.getLogger("Unmanic.Plugin.encoder_audio_ac3")
 
+def _extensions_for_mimetype_categories(categories):
+    """
+    Build the set of file extensions that resolve to a mimetype in the given
+    categories, from the same tables the Probe mimetype test consults.
+
+    :param categories:
+    :return:
+    """
+    mimetypes.init()
+    extensions = set()
+    for extension, mimetype in mimetypes.types_map.items():
+        if mimetype.split('/')[0] in categories:
+            extensions.add(extension.lower())
+    for extension, mimetype in MimetypeOverrides().get_all().items():
+        if mimetype.split('/')[0] in categories:
+            extensions.add(extension.lower())
+    return frozenset(extensions)
+
+
+# Extensions that can resolve to an audio or video mimetype.
+# Used as a fast pre-filter so library scans over mixed directories do not
+# construct a Probe for obvious non-media files. Derived from the mimetype
+# tables rather than hardcoded, so everything the probe would accept passes.
+_media_extensions = _extensions_for_mimetype_categories({'audio', 'video'})
+
+# Probe results cached per directory during library scans.
+# Library scans call on_library_management_file_test once per file. Media
+# libraries are commonly laid out as a directory of sibling episodes, so when
+# a file of a directory is tested a bounded window of its siblings is probed
+# in one batch (a few ffprobe processes in parallel) and the following sibling
+# tests become dictionary lookups.
+_dir_probe_cache = {}
+_dir_probe_cache_lock = threading.Lock()
+_dir_probe_cache_max_dirs = 4
+# Directories with a batch probe currently running. A concurrent caller for
+# the same directory falls back to probing just its own file rather than
+# launching a duplicate whole-directory batch.
+_dir_probe_in_flight = set()
+# At most this many sibling files are probed per batch (a window starting at
+# the requested file), so the first test in a huge flat directory does not
+# stall the scanner while every sibling is probed.
+_dir_probe_batch_limit = 16
+
+# Cache Settings objects per library.
+# Re-reading the plugin configuration for every file tested is redundant I/O.
+_settings_cache = {}
+
+
+def _get_settings(library_id=None):
+    """
+    Fetch a cached Settings object for the given library
+    (maintain compatibility with v1 plugins when no library ID is provided)
+
+    :param library_id:
+    :return:
+    """
+    settings = _settings_cache.get(library_id)
+    if settings is None:
+        if library_id:
+            settings = Settings(library_id=library_id)
+        else:
+            settings = Settings()
+        _settings_cache[library_id] = settings
+    return settings
+
 
 class Settings(PluginSettings):
     settings = {
@@ -45,18 +118,31 @@ class Settings(PluginSettings):
 
     def __init__(self, *args, **kwargs):
         super(Settings, self).__init__(*args, **kwargs)
-        self.form_settings = {
-            "advanced":              {
-                "label": "Write your own FFmpeg params",
-            },
-            "max_muxing_queue_size": self.__set_max_muxing_queue_size_form_settings(),
-            "main_options":          self.__set_main_options_form_settings(),
-            "advanced_options":      self.__set_advanced_options_form_settings(),
-            "custom_options":        self.__set_custom_options_form_settings(),
-            "codec_selection_mode":  self.__set_codec_selection_mode_form_settings(),
-            "selected_codecs":       self.__set_selected_codecs_form_settings(),
-        }
-
+        self._form_settings = None
+
+    @property
+    def form_settings(self):
+        # The form settings are only consumed when the plugin settings page is
+        # rendered. Building them requires several get_setting() calls, so this
+        # is deferred rather than paid by every runner that creates a Settings
+        # object.
+        if self._form_settings is None:
+            self._form_settings = {
+                "advanced":              {
+                    "label": "Write your own FFmpeg params",
+                },
+                "max_muxing_queue_size": self.__set_max_muxing_queue_size_form_settings(),
+                "main_options":          self.__set_main_options_form_settings(),
+                "advanced_options":      self.__set_advanced_options_form_settings(),
+                "custom_options":        self.__set_custom_options_form_settings(),
+                "codec_selection_mode":  self.__set_codec_selection_mode_form_settings(),
+                "selected_codecs":       self.__set_selected_codecs_form_settings(),
+            }
+        return self._form_settings
+
+    @form_settings.setter
+    def form_settings(self, value):
+        self._form_settings = value
 
     def __set_codec_selection_mode_form_settings(self):
         return {
@@ -138,12 +224,64 @@ class Settings(PluginSettings):
         return values
 
 
+# AC3 bit rate indexed by (clamped) source channel count. Index 0 is unused.
+_bitrate_by_channels = ('224', '224', '224', '448', '448', '640', '640')
+
+
+@functools.lru_cache(maxsize=16)
+def _bitrate_for_channels(channels):
+    """
+    Resolve a source channel count to the (bitrate, clamped channels) pair.
+    A pure function of the channel count, so memoised - only a handful of
+    distinct channel counts exist in practice.
+
+    :param channels:
+    :return:
+    """
+    # If no channel count is provided, assume the highest for AC3.
+    # Clamp to 6 channels - ffmpeg cannot encode > 6 channels of AC3 audio.
+    channels = min(int(channels), 6) if channels else 6
+    return _bitrate_by_channels[channels], channels
+
+
 class PluginStreamMapper(StreamMapper):
     def __init__(self):
         super(PluginStreamMapper, self).__init__(logger, ['audio'])
         self.codec = 'ac3'
         self.encoder = 'ac3'
         self.settings = None
+        # Snapshot of the settings read on the per-stream path
+        self._advanced = False
+        self._custom_options = []
+
+    def reset(self):
+        """
+        Reset all mapper state so this instance can be safely re-used for another file
+
+        :return:
+        """
+        # Reset the base StreamMapper state (mirrors the defaults set by StreamMapper.__init__)
+        self.probe = None
+        self.found_streams_to_encode = False
+        self.stream_mapping = []
+        self.stream_encoding = []
+        self.video_stream_count = 0
+        self.audio_stream_count = 0
+        self.subtitle_stream_count = 0
+        self.data_stream_count = 0
+        self.attachment_stream_count = 0
+        self.input_file = ''
+        self.output_file = ''
+        self.main_options = []
+        self.advanced_options = [
+            '-strict', '-2',
+            '-max_muxing_queue_size', '4096',
+        ]
+        self.format_options = []
+        # Reset the plugin state
+        self.settings = None
+        self._advanced = False
+        self._custom_options = []
 
     def set_default_values(self, settings, abspath, probe):
         """
@@ -162,64 +300,58 @@ class PluginStreamMapper(StreamMapper):
         # Configure settings
         self.settings = settings
 
+        # Snapshot the settings read once per stream so custom_stream_mapping
+        # does not need to hit the settings store for every stream.
+        # Only split the option strings when they are non-empty - these are
+        # usually blank textareas.
+        self._advanced = settings.get_setting('advanced')
+        self._custom_options = []
+
         # Build default options of advanced mode
-        if self.settings.get_setting('advanced'):
+        if self._advanced:
+            custom_options = settings.get_setting('custom_options')
+            if custom_options:
+                self._custom_options = custom_options.split()
             # If any main options are provided, overwrite them
-            main_options = settings.get_setting('main_options').split()
+            main_options = settings.get_setting('main_options')
+            main_options = main_options.split() if main_options else None
             if main_options:
                 # Overwrite all main options
                 self.main_options = main_options
             # If any advanced options are provided, overwrite them
-            advanced_options = settings.get_setting('advanced_options').split()
+            advanced_options = settings.get_setting('advanced_options')
+            advanced_options = advanced_options.split() if advanced_options else None
             if advanced_options:
                 # Overwrite all advanced options
                 self.advanced_options = advanced_options
 
     @staticmethod
     def calculate_bitrate(stream_info: dict):
-        channels = stream_info.get('channels')
-        # If no channel count is provided, assume the highest for AC3
-        if not channels:
-            logger.debug("Stream did not contain 'channels'. Setting max AC3 bit rate (640k).")
-            return '640'
-
-        if int(channels) > 6:
-            channels = 6
-
-        # Determine bitrate based on source channel count
-        if int(channels) <= 2:
-            logger.debug("Stream 'channels' is <= 2. Setting AC3 bit rate to 448k.")
-            return '224'
-        elif int(channels) <= 4:
-            logger.debug("Stream 'channels' is <= 4. Setting AC3 bit rate to 448k.")
-            return '448'
-        elif int(channels) <= 6:
-            logger.debug("Stream 'channels' is <= 6. Setting max AC3 bit rate (640k).")
-            return '640'
-
-        # Default to best quality
-        logger.debug("Stream 'bit_rate' could not be matched directly ({}). Setting max AC3 bit rate.".format(
-            channels))
-        return '640'
+        """
+        Calculate the AC3 bit rate and the clamped output channel count for a stream
+
+        :param stream_info:
+        :return: tuple of (bitrate, channels)
+        """
+        bitrate, channels = _bitrate_for_channels(stream_info.get('channels'))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Stream 'channels' is {}. Setting AC3 bit rate to {}k.".format(channels, bitrate))
+        return bitrate, channels
 
     def test_stream_needs_processing(self, stream_info: dict):
         # Ignore streams already of the required codec_name
-        if stream_info.get('codec_name').lower() in [self.codec]:
-            return False
-        return True
+        # (also handles streams missing a 'codec_name' entirely)
+        return (stream_info.get('codec_name') or '').lower() != self.codec
 
     def custom_stream_mapping(self, stream_info: dict, stream_id: int):
         stream_encoding = ['-c:a:{}'.format(stream_id), self.encoder]
-        if self.settings.get_setting('advanced'):
-            stream_encoding += self.settings.get_setting('custom_options').split()
+        if self._advanced:
+            stream_encoding += self._custom_options
         else:
             # Automatically detect bitrate for this stream.
             if stream_info.get('channels'):
-                # Use 64K for the bitrate per channel
-                calculated_bitrate = self.calculate_bitrate(stream_info)
-                channels = int(stream_info.get('channels'))
-                if int(channels) > 6:
-                    channels = 6
+                # Bitrate and clamped channel count are calculated in a single pass
+                calculated_bitrate, channels = self.calculate_bitrate(stream_info)
                 stream_encoding += [
                     '-ac:a:{}'.format(stream_id), '{}'.format(channels), '-b:a:{}'.format(stream_id), "{}k".format(calculated_bitrate)
                 ]
@@ -230,6 +362,175 @@ class PluginStreamMapper(StreamMapper):
         }
 
 
+def _probe_media_file(path):
+    """
+    Probe a single media file, returning (basename, mtime, probe_info).
+    The probe_info will be None for files that could not be probed.
+
+    :param path:
+    :return:
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return os.path.basename(path), 0, None
+    probe = Probe(logger, allowed_mimetypes=['audio', 'video'])
+    if not probe.file(path):
+        return os.path.basename(path), mtime, None
+    return os.path.basename(path), mtime, probe.get_probe()
+
+
+def _batch_probe_directory(abspath):
+    """
+    Fetch the probe info for the given file from the directory batch cache.
+    On a miss, a bounded window of sibling media files starting at this file
+    is probed in one batch. Returns a (found, probe_info) tuple - probe_info
+    is None when a probe already determined that the file cannot be probed.
+
+    :param abspath:
+    :return:
+    """
+    dirpath = os.path.dirname(abspath)
+    file_name = os.path.basename(abspath)
+
+    with _dir_probe_cache_lock:
+        dir_entry = _dir_probe_cache.get(dirpath)
+        cached = dir_entry.get(file_name) if dir_entry else None
+        # Only start a batch when this file is unknown and no other thread is
+        # already probing this directory
+        batch_needed = cached is None and dirpath not in _dir_probe_in_flight
+        if batch_needed:
+            _dir_probe_in_flight.add(dirpath)
+
+    if batch_needed:
+        try:
+            # Probe a bounded window of sibling media files starting at the
+            # requested file. Siblings are sorted so consecutive file tests
+            # walk through the directory window by window.
+            try:
+                siblings = sorted(
+                    basename for basename in os.listdir(dirpath)
+                    if os.path.splitext(basename)[1].lower() in _media_extensions
+                )
+            except OSError:
+                siblings = [file_name]
+            try:
+                start = siblings.index(file_name)
+            except ValueError:
+                start = 0
+            window = siblings[start:start + _dir_probe_batch_limit]
+            batch = {}
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for basename, mtime, probe_info in executor.map(
+                        _probe_media_file, (os.path.join(dirpath, basename) for basename in window)):
+                    batch[basename] = (mtime, probe_info)
+            with _dir_probe_cache_lock:
+                dir_entry = _dir_probe_cache.setdefault(dirpath, {})
+                dir_entry.update(batch)
+                # Evict the oldest directories to keep the cache bounded
+                while len(_dir_probe_cache) > _dir_probe_cache_max_dirs:
+                    _dir_probe_cache.pop(next(iter(_dir_probe_cache)))
+        finally:
+            with _dir_probe_cache_lock:
+                _dir_probe_in_flight.discard(dirpath)
+        cached = dir_entry.get(file_name)
+
+    if not cached:
+        return False, None
+    mtime, probe_info = cached
+    try:
+        current_mtime = os.path.getmtime(abspath)
+    except OSError:
+        return False, None
+    if current_mtime != mtime:
+        # File changed since it was probed - refresh the cached entry
+        file_name, mtime, probe_info = _probe_media_file(abspath)
+        with _dir_probe_cache_lock:
+            dir_entry = _dir_probe_cache.get(dirpath)
+            if dir_entry is not None:
+                dir_entry[file_name] = (mtime, probe_info)
+    return True, probe_info
+
+
+# Each worker thread re-uses a single PluginStreamMapper instance rather than
+# constructing (and re-validating the ffmpeg install for) one per file.
+_tls = threading.local()
+
+
+def _get_mapper():
+    """
+    Fetch a thread-local PluginStreamMapper, reset ready for a new file
+
+    :return:
+    """
+    mapper = getattr(_tls, 'mapper', None)
+    if mapper is None:
+        mapper = PluginStreamMapper()
+        _tls.mapper = mapper
+    else:
+        mapper.reset()
+    return mapper
+
+
+def _encoder_settings_hash(settings):
+    """
+    Build a short fingerprint of the settings that influence the encode.
+    Used to detect when a previously recorded encode was made with a
+    different plugin configuration.
+
+    :param settings:
+    :return:
+    """
+    fingerprint = {
+        'advanced':             settings.get_setting('advanced'),
+        'main_options':         settings.get_setting('main_options'),
+        'advanced_options':     settings.get_setting('advanced_options'),
+        'custom_options':       settings.get_setting('custom_options'),
+        'codec_selection_mode': settings.get_setting('codec_selection_mode'),
+        'selected_codecs':      settings.get_setting('selected_codecs'),
+    }
+    return hashlib.md5(str(fingerprint).encode('utf-8')).hexdigest()
+
+
+def _encode_marker(settings_hash, path):
+    """
+    Build the marker recorded against an encoded file.
+    The marker carries the settings fingerprint plus the file's mtime and
+    size, so a file later replaced with a new copy under the same name (eg.
+    an upgrade) no longer matches and is encoded again.
+
+    :param settings_hash:
+    :param path:
+    :return:
+    """
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return '{}:{}:{}'.format(settings_hash, file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def file_already_encoded(settings, path):
+    directory_info = UnmanicDirectoryInfo(os.path.dirname(path))
+
+    try:
+        previous_marker = directory_info.get('encoder_audio_ac3', os.path.basename(path))
+    except NoSectionError:
+        previous_marker = ''
+    except NoOptionError:
+        previous_marker = ''
+    except Exception as e:
+        logger.debug("Unknown exception %s.", e)
+        previous_marker = ''
+
+    if previous_marker and previous_marker == _encode_marker(_encoder_settings_hash(settings), path):
+        logger.debug("File '%s' was previously encoded with the current settings.", path)
+        return True
+
+    # Default to...
+    return False
+
+
 def on_library_management_file_test(data):
     """
     Runner function - enables additional actions during the library management file tests.
@@ -246,28 +547,53 @@ def on_library_management_file_test(data):
     # Get the path to the file
     abspath = data.get('path')
 
-    # Get file probe
-    probe = Probe(logger, allowed_mimetypes=['audio', 'video'])
-    if not probe.file(abspath):
-        # File probe failed, skip the rest of this test
+    # Fast extension check before doing any probing
+    if os.path.splitext(abspath)[1].lower() not in _media_extensions:
         return data
 
     # Configure settings object (maintain compatibility with v1 plugins)
-    if data.get('library_id'):
-        settings = Settings(library_id=data.get('library_id'))
+    settings = _get_settings(data.get('library_id'))
+
+    # If a previous task already encoded this file with the current settings,
+    # skip the probe and mapping work entirely
+    if file_already_encoded(settings, abspath):
+        logger.debug("File '%s' was previously encoded with the current settings - skipping.", abspath)
+        return data
+
+    # Get file probe
+    probe = Probe(logger, allowed_mimetypes=['audio', 'video'])
+    shared_probe = data.get('shared_info', {}).get('ffprobe')
+    if shared_probe:
+        # Reuse the probe data shared by a previous runner
+        if not probe.set_probe(shared_probe):
+            # Failed to set ffprobe from shared info.
+            # Probably due to it being for an incompatible mimetype declared above
+            return data
     else:
-        settings = Settings()
+        # Fetch from (or populate) the directory batch probe cache
+        found, probe_info = _batch_probe_directory(abspath)
+        if found:
+            if not probe_info or not probe.set_probe(probe_info):
+                # The batch already determined this file cannot be probed
+                return data
+        elif not probe.file(abspath):
+            # File probe failed, skip the rest of this test
+            return data
+    # Set file probe to shared info for subsequent file test runners
+    if 'shared_info' not in data:
+        data['shared_info'] = {}
+    data['shared_info']['ffprobe'] = probe.get_probe()
 
     # Get stream mapper
-    mapper = PluginStreamMapper()
+    mapper = _get_mapper()
     mapper.set_default_values(settings, abspath, probe)
 
     if mapper.streams_need_processing():
         # Mark this file to be added to the pending tasks
         data['add_file_to_pending_tasks'] = True
-        logger.debug("File '{}' should be added to task list. Probe found streams require processing.".format(abspath))
+        logger.debug("File '%s' should be added to task list. Probe found streams require processing.", abspath)
     else:
-        logger.debug("File '{}' does not contain streams require processing.".format(abspath))
+        logger.debug("File '%s' does not contain streams require processing.", abspath)
 
     return data
 
@@ -295,17 +621,37 @@ def on_worker_process(data):
     # Get the path to the file
     abspath = data.get('file_in')
 
+    # Fast extension check before doing any probing
+    if os.path.splitext(abspath)[1].lower() not in _media_extensions:
+        return data
+
+    # Configure settings object (maintain compatibility with v1 plugins)
+    settings = _get_settings(data.get('library_id'))
+
+    # If a previous task already encoded this file with the current settings,
+    # skip the probe and mapping work entirely
+    if file_already_encoded(settings, data.get('original_file_path', abspath)):
+        return data
+
     # Get file probe
     probe = Probe(logger, allowed_mimetypes=['audio', 'video'])
-    if not probe.file(abspath):
+    shared_probe = data.get('shared_info', {}).get('ffprobe', {})
+    if shared_probe.get('format', {}).get('filename') == abspath:
+        # Reuse the probe data shared by a previous runner for this same file
+        if not probe.set_probe(shared_probe):
+            # Failed to set ffprobe from shared info.
+            # Probably due to it being for an incompatible mimetype declared above
+            return data
+    elif not probe.file(abspath):
         # File probe failed, skip the rest of this test
         return data
-
-    # Configure settings object (maintain compatibility with v1 plugins)
-    settings = Settings(library_id=data.get('library_id'))
+    # Set file probe to shared info for subsequent runners
+    if 'shared_info' not in data:
+        data['shared_info'] = {}
+    data['shared_info']['ffprobe'] = probe.get_probe()
 
     # Get stream mapper
-    mapper = PluginStreamMapper()
+    mapper = _get_mapper()
     mapper.set_default_values(settings, abspath, probe)
 
     if mapper.streams_need_processing():
@@ -326,3 +672,40 @@ def on_worker_process(data):
         parser = Parser(logger)
         parser.set_probe(probe)
         data['command_progress_parser'] = parser.parse_progress
+
+
+def on_postprocessor_task_results(data):
+    """
+    Runner function - provides a means for additional postprocessor functions based on the task success.
+
+    The 'data' object argument includes:
+        task_processing_success         - Boolean, did all task processes complete successfully.
+        file_move_processes_success     - Boolean, did all postprocessor movement tasks complete successfully.
+        destination_files               - List containing all file paths created by postprocessor file movements.
+        source_data                     - Dictionary containing data pertaining to the original source file.
+
+    :param data:
+    :return:
+
+    """
+    # We only care that the task completed successfully.
+    # If a worker processing task was unsuccessful, dont mark the file as encoded
+    if not data.get('task_processing_success'):
+        return data
+
+    # Configure settings object (maintain compatibility with v1 plugins)
+    settings = _get_settings(data.get('library_id'))
+    settings_hash = _encoder_settings_hash(settings)
+
+    # Loop over the destination_files list and record the settings used against each one
+    for destination_file in data.get('destination_files'):
+        marker = _encode_marker(settings_hash, destination_file)
+        if not marker:
+            # The file could not be stat'ed; do not record a marker for it
+            continue
+        directory_info = UnmanicDirectoryInfo(os.path.dirname(destination_file))
+        directory_info.set('encoder_audio_ac3', os.path.basename(destination_file), marker)
+        directory_info.save()
+        logger.debug("Audio encode recorded for '%s' in .unmanic file.", destination_file)
+
+    return data
@@ -17,7 +17,9 @@
         You should have received a copy of the GNU General Public License along with this program.
         If not, see <https://www.gnu.org/licenses/>.
 """
+import functools
 import logging
+import mimetypes
 import os
 import re
 
@@ -25,10 +27,69 @@ from unmanic.libs.unplugins.settings import PluginSettings
 from unmanic.libs.directoryinfo import UnmanicDirectoryInfo
 
 from extract_ass_subtitles_to_files.lib.ffmpeg import StreamMapper, Probe, Parser
+from extract_ass_subtitles_to_files.lib.ffmpeg.mimetype_overrides import MimetypeOverrides
 
 # Configure plugin logger
 logger = logging.getLogger("Unmanic.Plugin.extract_ass_subtitles_to_files")
 
+def _extensions_for_mimetype_categories(categories):
+    """
+    Build the set of file extensions that resolve to a mimetype in the given
+    categories, from the same tables the Probe mimetype test consults.
+
+    :param categories:
+    :return:
+    """
+    mimetypes.init()
+    extensions = set()
+    for extension, mimetype in mimetypes.types_map.items():
+        if mimetype.split('/')[0] in categories:
+            extensions.add(extension.lower())
+    for extension, mimetype in MimetypeOverrides().get_all().items():
+        if mimetype.split('/')[0] in categories:
+            extensions.add(extension.lower())
+    return frozenset(extensions)
+
+
+# Extensions that can resolve to a video mimetype.
+# Used as a fast pre-filter so library scans over mixed directories do not
+# construct a Probe for obvious non-video files. Derived from the mimetype
+# tables rather than hardcoded, so everything the probe would accept passes.
+_video_extensions = _extensions_for_mimetype_categories({'video'})
+
+# Precompiled patterns used on the per-stream hot path.
+# The subtitle tag pattern must stay a regex: \s also matches Unicode
+# whitespace (eg. U+00A0, U+3000 in CJK stream titles), which a bytes-level
+# translation table cannot cover.
+_whitespace_re = re.compile(r'\s')
+_subtitle_tag_re = re.compile(r'\s|/|\\')
+
+# Cache probe streams discovered during library file tests keyed by the source
+# file path. This saves the post-processor from re-probing the source file.
+_probe_streams_cache = {}
+
+# Cache Settings objects per library.
+# Re-reading the plugin configuration for every file tested is redundant I/O.
+_settings_cache = {}
+
+
+def _get_settings(library_id=None):
+    """
+    Fetch a cached Settings object for the given library
+    (maintain compatibility with v1 plugins when no library ID is provided)
+
+    :param library_id:
+    :return:
+    """
+    settings = _settings_cache.get(library_id)
+    if settings is None:
+        if library_id:
+            settings = Settings(library_id=library_id)
+        else:
+            settings = Settings()
+        _settings_cache[library_id] = settings
+    return settings
+
 
 class Settings(PluginSettings):
     settings = {
@@ -54,16 +115,24 @@ class PluginStreamMapper(StreamMapper):
         super(PluginStreamMapper, self).__init__(logger, ['subtitle'])
         self.sub_streams = []
         self.settings = None
+        self._language_list = None
 
     def set_settings(self, settings):
         self.settings = settings
+        # Invalidate the cached language list when the settings change
+        self._language_list = None
 
     def _get_language_list(self):
-        language_list = self.settings.get_setting('languages_to_extract')
-        language_list = re.sub('\s', '-', language_list)
-        languages = list(filter(None, language_list.lower().split(',')))
+        # Parse the configured language list once and cache it.
+        # This is called for every stream of every file tested.
+        if self._language_list is None:
+            language_list = self.settings.get_setting('languages_to_extract')
+            language_list = _whitespace_re.sub('-', language_list)
+            languages = list(filter(None, language_list.lower().split(',')))
+            # Store as a frozenset for O(1) membership tests
+            self._language_list = frozenset(language.strip() for language in languages)
 
-        return [language.strip() for language in languages]
+        return self._language_list
 
     def test_stream_needs_processing(self, stream_info: dict):
         """Any text based will need to be processed"""
@@ -74,7 +143,7 @@ class PluginStreamMapper(StreamMapper):
         languages = self._get_language_list()
 
         # If no languages specified, extract all
-        if len(languages) == 0:
+        if not languages:
             return True
 
         language_tag = stream_info.get('tags').get('language', '').lower()
@@ -92,7 +161,7 @@ class PluginStreamMapper(StreamMapper):
         languages = self._get_language_list()
 
         # Skip stream
-        if len(languages) > 0 and language_tag not in languages:
+        if languages and language_tag not in languages:
             return {
                 'stream_mapping':  [],
                 'stream_encoding': [],
@@ -112,7 +181,7 @@ class PluginStreamMapper(StreamMapper):
             subtitle_tag = "{}.{}".format(subtitle_tag, stream_info.get('index'))
 
         # Ensure subtitle tag does not contain whitespace or slashes
-        subtitle_tag = re.sub('\s|/|\\\\', '-', subtitle_tag)
+        subtitle_tag = _subtitle_tag_re.sub('-', subtitle_tag)
 
         self.sub_streams.append(
             {
@@ -153,8 +222,21 @@ class PluginStreamMapper(StreamMapper):
 
         return args
 
+@functools.lru_cache(maxsize=256)
+def _dir_info(dirpath):
+    """
+    Fetch a cached UnmanicDirectoryInfo object for the given directory.
+    Scanning a directory of N media files otherwise re-reads and re-parses
+    the same .unmanic file N times.
+
+    :param dirpath:
+    :return:
+    """
+    return UnmanicDirectoryInfo(dirpath)
+
+
 def ass_already_extracted(settings, path):
-    directory_info = UnmanicDirectoryInfo(os.path.dirname(path))
+    directory_info = _dir_info(os.path.dirname(path))
 
     try:
         already_extracted = directory_info.get('extract_ass_subtitles_to_files', os.path.basename(path))
@@ -163,11 +245,11 @@ def ass_already_extracted(settings, path):
     except NoOptionError as e:
         already_extracted = ''
     except Exception as e:
-        logger.debug("Unknown exception {}.".format(e))
+        logger.debug("Unknown exception %s.", e)
         already_extracted = ''
 
     if already_extracted:
-        logger.debug("File's ass subtitle streams were previously extracted with {}.".format(already_extracted))
+        logger.debug("File's ass subtitle streams were previously extracted with %s.", already_extracted)
         return True
 
     # Default to...
@@ -190,14 +272,20 @@ def on_library_management_file_test(data):
 
     """
     # Configure settings object (maintain compatibility with v1 plugins)
-    if data.get('library_id'):
-        settings = Settings(library_id=data.get('library_id'))
-    else:
-        settings = Settings()
+    settings = _get_settings(data.get('library_id'))
 
     # Get the path to the file
     abspath = data.get('path')
 
+    # Fast extension check before doing any probing
+    if os.path.splitext(abspath)[1].lower() not in _video_extensions:
+        return data
+
+    # Check the directory info record first - this is much cheaper than probing the file
+    if ass_already_extracted(settings, abspath):
+        logger.debug("File '%s' has been previously had ass extracted.", abspath)
+        return data
+
     # Get file probe
     probe = Probe(logger, allowed_mimetypes=['video'])
     if 'ffprobe' in data.get('shared_info', {}):
@@ -208,22 +296,19 @@ def on_library_management_file_test(data):
     elif not probe.file(abspath):
         # File probe failed, skip the rest of this test
         return
-    # Set file probe to shared infor for subsequent file test runners
-    if 'shared_info' in data:
+    # Set file probe to shared info for subsequent file test runners
+    if 'shared_info' not in data:
         data['shared_info'] = {}
     data['shared_info']['ffprobe'] = probe.get_probe()
 
-    # Get stream mapper
-    mapper = PluginStreamMapper()
-    mapper.set_settings(settings)
-    mapper.set_probe(probe)
+    # Stash the probed streams for the post-processor stage
+    if len(_probe_streams_cache) > 512:
+        _probe_streams_cache.clear()
+    _probe_streams_cache[abspath] = probe.get_probe().get('streams', [])
 
-    if not ass_already_extracted(settings, abspath):
-        # Mark this file to be added to the pending tasks
-        data['add_file_to_pending_tasks'] = True
-        logger.debug("File '{}' should be added to task list. File has not been previously had ass extracted.".format(abspath))
-    else:
-        logger.debug("File '{}' has been previously had ass extracted.".format(abspath))                           
+    # Mark this file to be added to the pending tasks
+    data['add_file_to_pending_tasks'] = True
+    logger.debug("File '%s' should be added to task list. File has not been previously had ass extracted.", abspath)
 
     return data
 
@@ -254,17 +339,22 @@ def on_worker_process(data):
     # Get the path to the file
     abspath = data.get('file_in')
 
+    # Fast extension check before doing any probing
+    if os.path.splitext(abspath)[1].lower() not in _video_extensions:
+        return data
+
     # Get file probe
+    # Only the subtitle streams are needed here, so restrict the probe to just
+    # the stream fields read by the stream mapper
     probe = Probe(logger, allowed_mimetypes=['video'])
-    if not probe.file(abspath):
+    if not probe.file(abspath,
+                      select_streams='s',
+                      show_entries='stream=index,codec_name,codec_type:stream_tags=language,title'):
         # File probe failed, skip the rest of this test
         return
 
-    if data.get('library_id'):
-        settings = Settings(library_id=data.get('library_id'))
-    else:
-        settings = Settings()
-        
+    settings = _get_settings(data.get('library_id'))
+
     if not ass_already_extracted(settings, data.get('file_in')):
         # Get stream mapper
         mapper = PluginStreamMapper()
@@ -272,25 +362,24 @@ def on_worker_process(data):
         mapper.set_settings(settings)
         mapper.set_probe(probe)
     
-        split_original_file_path = os.path.splitext(data.get('original_file_path'))
-        original_file_directory = os.path.dirname(data.get('original_file_path'))
-    
+        # The splitext root keeps the directory, so this is the full path without the container extension
+        original_file_path_no_ext = os.path.splitext(data.get('original_file_path'))[0]
+
         if mapper.streams_need_processing():
             # Set the input file
             mapper.set_input_file(abspath)
-    
+
             # Get generated ffmpeg args
             ffmpeg_args = mapper.get_ffmpeg_args()
-    
+
             # Append STR extract args
             for sub_stream in mapper.sub_streams:
                 stream_mapping = sub_stream.get('stream_mapping', [])
                 subtitle_tag = sub_stream.get('subtitle_tag')
-    
-                ffmpeg_args += stream_mapping
-                ffmpeg_args += [
+
+                ffmpeg_args += stream_mapping + [
                     "-y",
-                    os.path.join(original_file_directory, "{}{}.ass".format(split_original_file_path[0], subtitle_tag)),
+                    "{}{}.ass".format(original_file_path_no_ext, subtitle_tag),
                 ]
     
             # Apply ffmpeg args to command
@@ -325,32 +414,36 @@ def on_postprocessor_task_results(data):
         return data
 
     # Configure settings object (maintain compatibility with v1 plugins)
-    if data.get('library_id'):
-        settings = Settings(library_id=data.get('library_id'))
-    else:
-        settings = Settings()
+    settings = _get_settings(data.get('library_id'))
 
     abspath = data.get('source_data').get('abspath')
-    probe_data=Probe(logger, allowed_mimetypes=['video'])
-    if probe_data.file(abspath):
-        probe_streams=probe_data.get_probe()["streams"]
-    else:
-        probe_streams=[]
+    # Reuse the streams probed during the library file test if we have them
+    probe_streams = _probe_streams_cache.pop(abspath, None)
+    if probe_streams is None:
+        probe_data = Probe(logger, allowed_mimetypes=['video'])
+        if probe_data.file(abspath):
+            probe_streams = probe_data.get_probe()["streams"]
+        else:
+            probe_streams = []
         
+    # Build the recorded subtitle language string once - it is identical for every destination file
+    langs = settings.get_setting('languages_to_extract')
+    subs = ""
+    if probe_streams:
+        sub_langs = [stream["tags"]["language"] for stream in probe_streams if
+                     stream.get("codec_type") == "subtitle" and "language" in stream.get("tags", {})]
+        if langs:
+            sub_langs = [i for i in sub_langs if i in langs]
+        subs = ' '.join(sub_langs)
+
     # Loop over the destination_files list and update the directory info file for each one
     for destination_file in data.get('destination_files'):
-        langs = ""
-        langs = settings.get_setting('languages_to_extract')
-        if probe_streams:
-            subs = [probe_streams[i]["tags"]["language"] for i in range(len(probe_streams)) if probe_streams[i]["codec_type"] == "subtitle" and "tags" in probe_streams[i] and "language" in probe_streams[i]["tags"]]
-            if langs:
-                subs = [i for i in subs if i in langs]
-            subs = ' '.join(subs)
-        else:
-            subs=""
         directory_info = UnmanicDirectoryInfo(os.path.dirname(destination_file))
         directory_info.set('extract_ass_subtitles_to_files', os.path.basename(destination_file), subs)
         directory_info.save()
         logger.info("ass subtitles processed for '{}' and recorded in .unmanic file.".format(destination_file))
 
+    # The .unmanic files were just modified - drop any cached directory info
+    _dir_info.cache_clear()
+
     return data                                                                                
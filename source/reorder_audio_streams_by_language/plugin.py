@@ -20,11 +20,17 @@
 
 """
 
+import functools
+import itertools
 import logging
 import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import pycountry
-from pyarr import RadarrAPI, SonarrAPI
+# Note: pyarr and pycountry are imported lazily inside the helpers that need
+# them. pycountry loads its full language dataset at import time, and neither
+# package is needed at all unless the Radarr/Sonarr integration is enabled.
 
 from unmanic.libs.unplugins.settings import PluginSettings
 
@@ -33,6 +39,53 @@ from reorder_audio_streams_by_language.lib.ffmpeg import Parser, Probe, StreamMa
 # Configure plugin logger
 logger = logging.getLogger("Unmanic.Plugin.reorder_audio_streams_by_language")
 
+# Stream classification results computed during library file tests, keyed on
+# the file path, its stat info and the settings that produced them. The worker
+# stage re-ran the whole probe + Arr lookup + classification pass for files
+# the library test had already decided needed reordering; on a cache hit it
+# can skip straight to assembling the ffmpeg args.
+_mapping_cache = OrderedDict()
+_mapping_cache_max_entries = 256
+
+# Probe objects keyed on the file path. Probing spawns an ffprobe subprocess
+# and parses its JSON output - the most expensive step in this module - and
+# both runners need the same result, so it is cached against the file's mtime.
+_probe_cache = OrderedDict()
+_probe_cache_max_entries = 128
+
+# ffmpeg stream specifier character per codec type
+_IDENT = {
+    "video": "v",
+    "audio": "a",
+    "subtitle": "s",
+    "data": "d",
+    "attachment": "t",
+}
+
+# Common video file extensions. Lookups are only prefetched for paths that
+# can plausibly be probed as video, so non-media files never generate Arr
+# traffic.
+_video_extensions = frozenset({
+    ".mkv", ".mp4", ".m4v", ".avi", ".mov", ".ts", ".m2ts", ".webm", ".wmv", ".flv", ".mpg", ".mpeg", ".vob",
+})
+
+# Thread pool for Arr language lookups. Submitting the lookup before the file
+# probe lets the network round-trip overlap with the ffprobe subprocess
+# instead of running after it. Threads are only spawned on first use.
+_arr_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="arr-lookup")
+# In-flight lookup futures keyed on the file path
+_langcode_futures = {}
+
+# Leading ffmpeg arguments shared by every generated command: copy all
+# streams and clear the default disposition before reassigning it
+_BASE_ARGS = ("-c", "copy", "-disposition:a", "-default")
+
+# Classification buckets, numbered in final output order
+_BUCKET_FIRST = 0
+_BUCKET_SEARCH = 1
+_BUCKET_UNMATCHED = 2
+_BUCKET_LAST = 3
+
 
 class Settings(PluginSettings):
     settings = {
@@ -43,21 +96,39 @@ class Settings(PluginSettings):
         "use_sonarr": False,
         "sonarr_url": "http://localhost:8989",
         "sonarr_api_key": "",
+        "cache_arr_responses": False,
     }
 
     def __init__(self, *args, **kwargs):
         super(Settings, self).__init__(*args, **kwargs)
-        self.form_settings = {
-            "Search String": {
-                "label": "Enter language code to move to 1st audio stream (likely a 3 letter code). Will be ignored if radarr or sonarr are enabled."
-            },
-            "use_radarr": {"label": "Attempt to use original language from Radarr"},
-            "radarr_url": self._radarr_url(),
-            "radarr_api_key": self._radarr_api_key(),
-            "use_sonarr": {"label": "Attempt to use original language from Sonarr"},
-            "sonarr_url": self._sonarr_url(),
-            "sonarr_api_key": self._sonarr_api_key(),
-        }
+        self._form_settings = None
+
+    @property
+    def form_settings(self):
+        # The form settings are only consumed when the plugin settings page is
+        # rendered, yet both runners build a Settings object for every file.
+        # Defer building the dict (and its get_setting calls) until it is
+        # actually accessed.
+        if self._form_settings is None:
+            self._form_settings = {
+                "Search String": {
+                    "label": "Enter language code to move to 1st audio stream (likely a 3 letter code). Will be ignored if radarr or sonarr are enabled."
+                },
+                "use_radarr": {"label": "Attempt to use original language from Radarr"},
+                "radarr_url": self._radarr_url(),
+                "radarr_api_key": self._radarr_api_key(),
+                "use_sonarr": {"label": "Attempt to use original language from Sonarr"},
+                "sonarr_url": self._sonarr_url(),
+                "sonarr_api_key": self._sonarr_api_key(),
+                "cache_arr_responses": {
+                    "label": "Cache Radarr/Sonarr responses on disk (speeds up repeated library scans)"
+                },
+            }
+        return self._form_settings
+
+    @form_settings.setter
+    def form_settings(self, value):
+        self._form_settings = value
 
     def _radarr_url(self):
         values = {
@@ -105,109 +176,417 @@ class Settings(PluginSettings):
 
         return values
 
-
-class PluginStreamMapper(StreamMapper):
-    def __init__(self, abspath):
-        # Check all streams (only the desired stream type will matter when tested)
-        super(PluginStreamMapper, self).__init__(
-            logger, ["video", "audio", "subtitle", "data", "attachment"]
+    def snapshot(self):
+        """
+        Fetch the settings consumed for every file as a single hashable tuple,
+        saving repeated walks of the settings store on the per-file paths.
+
+        :return:
+        """
+        get_setting = self.get_setting
+        return (
+            get_setting("Search String"),
+            get_setting("use_radarr"),
+            get_setting("radarr_url"),
+            get_setting("radarr_api_key"),
+            get_setting("use_sonarr"),
+            get_setting("sonarr_url"),
+            get_setting("sonarr_api_key"),
         )
-        self.settings = None
 
-        self.search_string = None
 
-        self.abspath = abspath
+def _stat_key(abspath):
+    """
+    Build a (path, mtime_ns, size) identity tuple for a file with a single
+    stat call, or None if the file cannot be stat'ed.
 
-        # The stream type we are considering as streams of interest
-        self.stream_type = "audio"
+    :param abspath:
+    :return:
+    """
+    try:
+        file_stat = os.stat(abspath, follow_symlinks=False)
+    except OSError:
+        return None
+    return (abspath, file_stat.st_mtime_ns, file_stat.st_size)
 
-        # Flag to say if a search string has matched a stream of interest
-        self.found_search_string_streams = False
 
-        # First streams are ones found before the search string was found on a stream of interest
-        self.first_stream_mapping = []
-        # Last streams are ones found after the search string was found on a stream of interest
-        self.last_stream_mapping = []
+def _ci_get(tags, key):
+    """
+    Case-insensitive dict get for ffprobe stream tags.
 
-        # Search string streams of interest are streams that contain the search string
-        self.search_string_stream_mapping = []
-        # Unmatched streams of interest are streams that do not contain the search string
-        self.unmatched_stream_mapping = []
+    Tag keys vary in case between containers ('language' vs 'LANGUAGE').
+    The lowercase key hits directly for most files; only unusual casings pay
+    for the fallback scan.
 
-    def set_settings(self, settings):
-        self.settings = settings
+    :param tags:
+    :param key:
+    :return:
+    """
+    value = tags.get(key)
+    if value is not None:
+        return value
+    key_lower = key.lower()
+    for tag_key, tag_value in tags.items():
+        if tag_key.lower() == key_lower:
+            return tag_value
+    return None
 
-    def set_langcode(self):
-        original_langcode = ''
 
-        if self.settings.get_setting("use_radarr"):
-            original_langcode = self.get_language_from_radarr()
+def _get_probe(abspath):
+    """
+    Fetch a Probe object for the given file, reusing a cached result when the
+    file has not changed since it was last probed.
 
-        if self.settings.get_setting("use_sonarr") and not original_langcode:
-            original_langcode = self.get_language_from_sonarr()
+    :param abspath:
+    :return:
+    """
+    stat_key = _stat_key(abspath)
+    if not stat_key:
+        return None
+    cached = _probe_cache.get(abspath)
+    if cached and cached[0] == stat_key:
+        _probe_cache.move_to_end(abspath)
+        return cached[1]
+    probe = Probe(logger, allowed_mimetypes=["video"])
+    if not probe.file(abspath):
+        # File probe failed
+        return None
+    _probe_cache[abspath] = (stat_key, probe)
+    _probe_cache.move_to_end(abspath)
+    while len(_probe_cache) > _probe_cache_max_entries:
+        _probe_cache.popitem(last=False)
+    return probe
 
-        self.search_string = original_langcode or self.settings.get_setting(
-            "Search String"
-        )
 
-    def get_language_from_radarr(self):
-        radarr_url = self.settings.get_setting("radarr_url")
-        radarr_api_key = self.settings.get_setting("radarr_api_key")
+def _prefetch_langcode(abspath, settings):
+    """
+    Start resolving the language for a file on the lookup pool.
+
+    :param abspath:
+    :param settings:
+    :return:
+    """
+    (search_string, use_radarr, radarr_url, radarr_api_key,
+     use_sonarr, sonarr_url, sonarr_api_key) = settings.snapshot()
+    if not (use_radarr or use_sonarr):
+        return
+    if os.path.splitext(abspath)[1].lower() not in _video_extensions:
+        # Not plausibly a video file; the probe below will almost certainly
+        # fail and nothing would consume the lookup
+        return
+    if abspath in _langcode_futures:
+        return
+    if settings.get_setting("cache_arr_responses"):
+        # Patch requests before the pool thread constructs the memoised API
+        # client, otherwise the first lookup builds an uncached session that
+        # is then reused for the rest of the process
+        _install_requests_cache()
+    _langcode_futures[abspath] = _arr_pool.submit(
+        _resolve_langcode,
+        abspath,
+        use_radarr,
+        radarr_url,
+        radarr_api_key,
+        use_sonarr,
+        sonarr_url,
+        sonarr_api_key,
+    )
+
+
+def _mapping_cache_key(abspath, settings):
+    """
+    Build the mapping cache key for a file, or None if the file cannot be stat'ed.
+
+    :param abspath:
+    :param settings:
+    :return:
+    """
+    stat_key = _stat_key(abspath)
+    if not stat_key:
+        return None
+    return stat_key + settings.snapshot()
 
-        if not radarr_url or not radarr_api_key:
-            return None
 
-        api = RadarrAPI(radarr_url, radarr_api_key)
+def _mapping_cache_store(key, probe, mapper):
+    """
+    Record a positive reorder decision against the given cache key.
+
+    :param key:
+    :param probe:
+    :param mapper:
+    :return:
+    """
+    _mapping_cache[key] = {
+        "probe":   probe,
+        "buckets": list(mapper._stream_buckets),
+        "kinds":   list(mapper._stream_kinds),
+        "ids":     list(mapper._stream_ids),
+    }
+    _mapping_cache.move_to_end(key)
+    while len(_mapping_cache) > _mapping_cache_max_entries:
+        _mapping_cache.popitem(last=False)
+
 
-        movie_data = api.lookup_movie(self.abspath)
+@functools.lru_cache(maxsize=512)
+def _lang_name_to_alpha3(name):
+    """
+    Resolve a language name (as reported by Radarr/Sonarr) to its alpha_3 code.
 
-        if len(movie_data) == 0:
-            return None
+    pycountry scans its full language table for a name lookup, so the result
+    is memoised; a library rarely spans more than a handful of languages.
 
-        original_language = movie_data[0].get("originalLanguage")
+    :param name:
+    :return:
+    """
+    import pycountry
+    lang = pycountry.languages.get(name=name)
+    return lang.alpha_3 if lang else None
 
-        if not original_language:
-            return None
 
-        lang = pycountry.languages.get(name=original_language["name"])
+@functools.lru_cache(maxsize=1)
+def _install_requests_cache():
+    """
+    Install a transparent on-disk cache for the requests library.
 
-        return lang.alpha_3 if lang else None
+    The Arr lookup endpoints return the same answer for the same path over
+    short horizons, so repeated library scans can be served from a local
+    SQLite cache instead of fresh HTTP round-trips. pyarr uses requests
+    internally, so no further wiring is needed.
 
-    def get_language_from_sonarr(self):
-        sonarr_url = self.settings.get_setting("sonarr_url")
-        sonarr_api_key = self.settings.get_setting("sonarr_api_key")
+    :return:
+    """
+    try:
+        import requests_cache
+    except ImportError:
+        logger.debug("Package 'requests_cache' is not available. Arr responses will not be cached on disk.")
+        return
+    requests_cache.install_cache(
+        cache_name=os.path.join(tempfile.gettempdir(), "reorder_audio_arr_cache"),
+        backend="sqlite",
+        expire_after=600,
+        allowable_methods=("GET",),
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _get_radarr_api(radarr_url, radarr_api_key):
+    # Reuse a single API client (and its underlying requests.Session) per
+    # configured server, keeping the HTTP connection alive between lookups
+    # instead of paying a TCP/TLS handshake per file.
+    from pyarr import RadarrAPI
+    return RadarrAPI(radarr_url, radarr_api_key)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_sonarr_api(sonarr_url, sonarr_api_key):
+    from pyarr import SonarrAPI
+    return SonarrAPI(sonarr_url, sonarr_api_key)
+
+
+# Health of the configured Arr servers, keyed on (url, api key).
+# A misconfigured or unreachable server would otherwise cost every single
+# file in the library a full failed-request timeout; one failed status check
+# disables lookups against that server for the rest of the process.
+_arr_health = {}
+
+
+def _arr_server_healthy(api, server_key):
+    """
+    Run a one-off status check against an Arr server the first time it is used.
 
-        if not sonarr_url or not sonarr_api_key:
-            return None
+    :param api:
+    :param server_key:
+    :return:
+    """
+    healthy = _arr_health.get(server_key)
+    if healthy is None:
+        try:
+            api.get_system_status()
+            healthy = True
+        except Exception as e:
+            logger.warning(
+                "Unable to reach Arr server '%s'. Disabling lookups against it until the plugin is reloaded. %s",
+                server_key[0], e)
+            healthy = False
+        _arr_health[server_key] = healthy
+    return healthy
 
-        api = SonarrAPI(sonarr_url, sonarr_api_key)
 
-        series_data = api.lookup_series(self.abspath)
+def _get_language_from_radarr(abspath, radarr_url, radarr_api_key):
+    if not radarr_url or not radarr_api_key:
+        return None
 
-        if len(series_data) == 0:
-            return None
+    api = _get_radarr_api(radarr_url, radarr_api_key)
 
-        original_language = series_data[0].get("originalLanguage")
+    if not _arr_server_healthy(api, (radarr_url, radarr_api_key)):
+        return None
 
-        if not original_language:
-            return None
+    movie_data = api.lookup_movie(abspath)
 
-        lang = pycountry.languages.get(name=original_language["name"])
+    if not movie_data:
+        return None
+
+    entry = movie_data[0]
+    original_language = entry.get("originalLanguage")
+
+    if not original_language:
+        return None
+
+    return _lang_name_to_alpha3(original_language["name"])
+
+
+def _get_language_from_sonarr(abspath, sonarr_url, sonarr_api_key):
+    if not sonarr_url or not sonarr_api_key:
+        return None
+
+    api = _get_sonarr_api(sonarr_url, sonarr_api_key)
+
+    if not _arr_server_healthy(api, (sonarr_url, sonarr_api_key)):
+        return None
+
+    series_data = api.lookup_series(abspath)
+
+    if not series_data:
+        return None
+
+    entry = series_data[0]
+    original_language = entry.get("originalLanguage")
+
+    if not original_language:
+        return None
+
+    return _lang_name_to_alpha3(original_language["name"])
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve_langcode(
+    abspath, use_radarr, radarr_url, radarr_api_key, use_sonarr, sonarr_url, sonarr_api_key
+):
+    """
+    Resolve the original language code for a file from Radarr/Sonarr.
+
+    Both the library file test and the worker process resolve the language for
+    the same file, and each lookup is an HTTP round-trip against the Arr
+    server. Memoising on the file path (plus the connection settings) means
+    only the first stage pays for the network call.
+
+    :param abspath:
+    :param use_radarr:
+    :param radarr_url:
+    :param radarr_api_key:
+    :param use_sonarr:
+    :param sonarr_url:
+    :param sonarr_api_key:
+    :return:
+    """
+    original_langcode = None
 
-        return lang.alpha_3 if lang else None
+    if use_radarr:
+        original_langcode = _get_language_from_radarr(abspath, radarr_url, radarr_api_key)
+
+    if use_sonarr and not original_langcode:
+        original_langcode = _get_language_from_sonarr(abspath, sonarr_url, sonarr_api_key)
+
+    return original_langcode
+
+
+class PluginStreamMapper(StreamMapper):
+    def __init__(self, abspath):
+        # Check all streams (only the desired stream type will matter when tested)
+        super(PluginStreamMapper, self).__init__(
+            logger, ["video", "audio", "subtitle", "data", "attachment"]
+        )
+        self.settings = None
+
+        self.search_string = None
+        # Lowercased copy of the search string, computed once per file rather
+        # than once per stream tag tested
+        self._needle_str = None
+
+        self.abspath = abspath
+
+        # The stream type we are considering as streams of interest
+        self.stream_type = "audio"
+
+        # Flag to say if a search string has matched a stream of interest
+        self.found_search_string_streams = False
+
+        # Classified streams kept as parallel arrays, one entry per stream in
+        # encounter order. The '-map' argument strings are only synthesised
+        # once, at emission time in order_stream_mapping.
+        #   _stream_buckets - which output bucket the stream landed in
+        #   _stream_kinds   - the ffmpeg stream specifier character
+        #   _stream_ids     - the per-type stream index
+        self._stream_buckets = []
+        self._stream_kinds = []
+        self._stream_ids = []
+
+        # Stream IDs of the streams of interest, kept as plain ints so the
+        # reorder test can compare positions without string parsing
+        self._search_ids = []
+        self._unmatched_ids = []
+
+        # Set when the probe shows no tagged streams of interest at all, in
+        # which case nothing can ever match the search string
+        self._trivial_skip = False
+
+    def set_settings(self, settings):
+        self.settings = settings
+
+    def set_probe(self, probe):
+        super(PluginStreamMapper, self).set_probe(probe)
+        # Prescan the probed streams once. A file whose streams of interest
+        # carry no language or title tags can never match the search string,
+        # so the whole classification pass can be skipped for it.
+        self._trivial_skip = True
+        for stream_info in probe.get("streams", []):
+            if stream_info.get("codec_type", "").lower() != self.stream_type:
+                continue
+            stream_tags = stream_info.get("tags")
+            if stream_tags and (
+                _ci_get(stream_tags, "language") or _ci_get(stream_tags, "title")
+            ):
+                self._trivial_skip = False
+                break
+
+    def set_langcode(self):
+        if self.settings.get_setting("cache_arr_responses"):
+            _install_requests_cache()
+
+        (search_string, use_radarr, radarr_url, radarr_api_key,
+         use_sonarr, sonarr_url, sonarr_api_key) = self.settings.snapshot()
+
+        # Collect a prefetched lookup if one is in flight for this file,
+        # otherwise resolve it on the calling thread
+        future = _langcode_futures.pop(self.abspath, None)
+        if future is not None:
+            original_langcode = future.result()
+        else:
+            original_langcode = _resolve_langcode(
+                self.abspath,
+                use_radarr,
+                radarr_url,
+                radarr_api_key,
+                use_sonarr,
+                sonarr_url,
+                sonarr_api_key,
+            )
+
+        self.search_string = original_langcode or search_string
+        self._needle_str = self.search_string.lower()
 
     def test_tags_for_search_string(self, stream_tags):
-        if stream_tags and True in list(
-            k.lower() in ["title", "language"] for k in stream_tags
-        ):
-            # Check if tag matches the "Search String"
-            if self.search_string.lower() in stream_tags.get("language", "").lower():
-                # Found a matching stream in language tag
-                return True
-            elif self.search_string in stream_tags.get("title", "").lower():
-                # Found a matching stream in title tag
-                return True
-        return False
+        if not stream_tags:
+            return False
+        needle = self._needle_str
+        # Check if tag matches the "Search String"
+        language = _ci_get(stream_tags, "language")
+        if language and needle in language.lower():
+            # Found a matching stream in language tag
+            return True
+        title = _ci_get(stream_tags, "title")
+        # Found a matching stream in title tag
+        return bool(title and needle in title.lower())
 
     def test_stream_needs_processing(self, stream_info: dict):
         # Always return true here.
@@ -215,48 +594,29 @@ class PluginStreamMapper(StreamMapper):
         return True
 
     def custom_stream_mapping(self, stream_info: dict, stream_id: int):
-        ident = {
-            "video": "v",
-            "audio": "a",
-            "subtitle": "s",
-            "data": "d",
-            "attachment": "t",
-        }
         codec_type = stream_info.get("codec_type").lower()
 
-        if codec_type == self.stream_type:
-            # Process streams of interest
-            if self.test_tags_for_search_string(stream_info.get("tags")):
-                self.found_search_string_streams = True
-                if len(self.search_string_stream_mapping) == 0:
-                    self.search_string_stream_mapping += [
-                        "-map",
-                        "0:{}:{}".format(ident.get(codec_type), stream_id),
-                        "-disposition:{}:{}".format(ident.get(codec_type), 0),
-                        "default",
-                    ]
-                else:
-                    self.search_string_stream_mapping += [
-                        "-map",
-                        "0:{}:{}".format(ident.get(codec_type), stream_id),
-                    ]
-            else:
-                self.unmatched_stream_mapping += [
-                    "-map",
-                    "0:{}:{}".format(ident.get(codec_type), stream_id),
-                ]
+        stream_of_interest = codec_type == self.stream_type
+        matched = stream_of_interest and self.test_tags_for_search_string(
+            stream_info.get("tags")
+        )
+
+        # Select the destination bucket for this stream
+        if matched:
+            self.found_search_string_streams = True
+            self._search_ids.append(stream_id)
+            bucket = _BUCKET_SEARCH
+        elif stream_of_interest:
+            self._unmatched_ids.append(stream_id)
+            bucket = _BUCKET_UNMATCHED
+        elif self.found_search_string_streams:
+            bucket = _BUCKET_LAST
         else:
-            # Process streams not of interest
-            if not self.found_search_string_streams:
-                self.first_stream_mapping += [
-                    "-map",
-                    "0:{}:{}".format(ident.get(codec_type), stream_id),
-                ]
-            else:
-                self.last_stream_mapping += [
-                    "-map",
-                    "0:{}:{}".format(ident.get(codec_type), stream_id),
-                ]
+            bucket = _BUCKET_FIRST
+
+        self._stream_buckets.append(bucket)
+        self._stream_kinds.append(_IDENT.get(codec_type))
+        self._stream_ids.append(stream_id)
 
         # Do not map any streams using the default method
         return {"stream_mapping": [], "stream_encoding": []}
@@ -264,37 +624,46 @@ class PluginStreamMapper(StreamMapper):
     def streams_to_be_reordered(self):
         result = False
 
+        # Nothing can match when no streams of interest are tagged
+        if self._trivial_skip:
+            return result
+
         # Start by mapping streams
         self.streams_need_processing()
 
         # Test if there were any matches against the search string
-        if self.search_string_stream_mapping and self.unmatched_stream_mapping:
+        if self._search_ids and self._unmatched_ids:
             logger.info("Streams were found matching the search string")
             # Test if the mapping is already in the correct order
-            counter = 0
-            for item in (
-                self.search_string_stream_mapping + self.unmatched_stream_mapping
+            for counter, original_position in enumerate(
+                itertools.chain(self._search_ids, self._unmatched_ids)
             ):
-                if "-map" in item or "-disposition" in item or "default" in item:
-                    continue
-                original_position = item.split(":")[-1]
-                if int(original_position) != int(counter):
+                if original_position != counter:
                     logger.info(
                         "The new order for the mapped streams will differ from the source file"
                     )
                     result = True
                     break
-                counter += 1
 
         return result
 
     def order_stream_mapping(self):
-        args = ["-c", "copy", "-disposition:a", "-default"]
-        args += self.first_stream_mapping
-        args += self.search_string_stream_mapping
-        args += self.unmatched_stream_mapping
-        args += self.last_stream_mapping
-        self.advanced_options += args
+        args = self.advanced_options
+        args.extend(_BASE_ARGS)
+        # Walk the classified streams once per bucket, synthesising the map
+        # argument strings only now that the final order is known
+        disposition_set = False
+        for bucket in (_BUCKET_FIRST, _BUCKET_SEARCH, _BUCKET_UNMATCHED, _BUCKET_LAST):
+            for stream_bucket, kind, stream_id in zip(
+                self._stream_buckets, self._stream_kinds, self._stream_ids
+            ):
+                if stream_bucket != bucket:
+                    continue
+                args.extend(("-map", f"0:{kind}:{stream_id}"))
+                if bucket == _BUCKET_SEARCH and not disposition_set:
+                    # The first matched stream also becomes the default stream
+                    args.extend((f"-disposition:{kind}:0", "default"))
+                    disposition_set = True
 
 
 def on_library_management_file_test(data):
@@ -313,18 +682,27 @@ def on_library_management_file_test(data):
     # Get the path to the file
     abspath = data.get("path")
 
-    # Get file probe
-    probe = Probe(logger, allowed_mimetypes=["video"])
-    if not probe.file(abspath):
-        # File probe failed, skip the rest of this test
-        return data
-
     # Configure settings object (maintain compatibility with v1 plugins)
     if data.get("library_id"):
         settings = Settings(library_id=data.get("library_id"))
     else:
         settings = Settings()
 
+    # Start the Arr language lookup in the background so the network wait
+    # overlaps with probing the file below
+    _prefetch_langcode(abspath, settings)
+
+    # Get file probe
+    probe = _get_probe(abspath)
+    if not probe:
+        # File probe failed, skip the rest of this test.
+        # Discard any in-flight lookup for this file; nothing below will
+        # consume it.
+        future = _langcode_futures.pop(abspath, None)
+        if future is not None:
+            future.cancel()
+        return data
+
     # Get stream mapper
     mapper = PluginStreamMapper(abspath)
     mapper.set_settings(settings)
@@ -332,6 +710,11 @@ def on_library_management_file_test(data):
     mapper.set_probe(probe)
 
     if mapper.streams_to_be_reordered():
+        # Record the classification so the worker stage can skip the
+        # probe/lookup/classification pass for this file
+        cache_key = _mapping_cache_key(abspath, settings)
+        if cache_key:
+            _mapping_cache_store(cache_key, probe, mapper)
         # Mark this file to be added to the pending tasks
         data["add_file_to_pending_tasks"] = True
         logger.debug(
@@ -370,46 +753,69 @@ def on_worker_process(data):
     # Get the path to the file
     abspath = data.get("file_in")
 
-    # Get file probe
-    probe = Probe(logger, allowed_mimetypes=["video"])
-    if not probe.file(abspath):
-        # File probe failed, skip the rest of this test
-        return data
-
     # Configure settings object (maintain compatibility with v1 plugins)
     if data.get("library_id"):
         settings = Settings(library_id=data.get("library_id"))
     else:
         settings = Settings()
 
-    # Get stream mapper
-    mapper = PluginStreamMapper(abspath)
-    mapper.set_settings(settings)
-    mapper.set_langcode()
-    mapper.set_probe(probe)
-
-    if mapper.streams_to_be_reordered():
-        # Set the input file
-        mapper.set_input_file(abspath)
-
-        # Set the output file
-        # Do not remux the file. Keep the file out in the same container
-        mapper.set_output_file(data.get("file_out"))
-
-        # Set the custom mapping order with the advanced options
-        mapper.order_stream_mapping()
-
-        # Get generated ffmpeg args
-        ffmpeg_args = mapper.get_ffmpeg_args()
-        logger.debug("ffmpeg_args: '{}'".format(ffmpeg_args))
-
-        # Apply ffmpeg args to command
-        data["exec_command"] = ["ffmpeg"]
-        data["exec_command"] += ffmpeg_args
-
-        # Set the parser
-        parser = Parser(logger)
-        parser.set_probe(probe)
-        data["command_progress_parser"] = parser.parse_progress
+    # Check for a classification recorded by the library file test.
+    # A hit means the file and settings are unchanged since the scan decided
+    # the streams need reordering, so the probe, the Arr lookup and the
+    # classification pass can all be skipped.
+    cache_key = _mapping_cache_key(abspath, settings)
+    cached_mapping = _mapping_cache.get(cache_key) if cache_key else None
+
+    if cached_mapping:
+        _mapping_cache.move_to_end(cache_key)
+        probe = cached_mapping.get("probe")
+
+        # Get stream mapper and restore the cached classification
+        mapper = PluginStreamMapper(data.get("original_file_path") or abspath)
+        mapper.set_settings(settings)
+        mapper._stream_buckets = list(cached_mapping.get("buckets"))
+        mapper._stream_kinds = list(cached_mapping.get("kinds"))
+        mapper._stream_ids = list(cached_mapping.get("ids"))
+    else:
+        # Get file probe
+        probe = _get_probe(abspath)
+        if not probe:
+            # File probe failed, skip the rest of this test
+            return data
+
+        # Get stream mapper
+        # The Arr lookups are done against the original file path so the worker
+        # stage hits the same cache entry as the library file test (the 'file_in'
+        # path may be a cached work file with a mangled name).
+        mapper = PluginStreamMapper(data.get("original_file_path") or abspath)
+        mapper.set_settings(settings)
+        mapper.set_langcode()
+        mapper.set_probe(probe)
+
+        if not mapper.streams_to_be_reordered():
+            return data
+
+    # Set the input file
+    mapper.set_input_file(abspath)
+
+    # Set the output file
+    # Do not remux the file. Keep the file out in the same container
+    mapper.set_output_file(data.get("file_out"))
+
+    # Set the custom mapping order with the advanced options
+    mapper.order_stream_mapping()
+
+    # Get generated ffmpeg args
+    ffmpeg_args = mapper.get_ffmpeg_args()
+    logger.debug("ffmpeg_args: '{}'".format(ffmpeg_args))
+
+    # Apply ffmpeg args to command
+    data["exec_command"] = ["ffmpeg"]
+    data["exec_command"] += ffmpeg_args
+
+    # Set the parser
+    parser = Parser(logger)
+    parser.set_probe(probe)
+    data["command_progress_parser"] = parser.parse_progress
 
     return data